@@ -11,10 +11,16 @@ import pandas as pd
 from datetime import datetime
 import time
 import os
+import threading
+from live_state import LiveStateRing, record_to_dict
 
 # Initialize the Dash app with Bootstrap theme
 app = dash.Dash(__name__, external_stylesheets=[dbc.themes.BOOTSTRAP])
 LOG_FILE = "predictions_log.json"
+live_state = None  # Shared-memory ring from predict.py, attached lazily
+# Callbacks run concurrently; attaching, reading and closing the ring must not
+# overlap or a close would unmap memory another thread is reading
+live_state_lock = threading.Lock()
 
 # Constants for CRB calculation
 C = 299792458.0  # Speed of light in m/s
@@ -29,9 +35,42 @@ def calculate_crb(noise_std=0.01):
         print(f"Error calculating CRB: {e}")
         return 0.0
 
+def get_live_state():
+    """
+    Attach to the predictor's shared-memory ring, or None if it isn't running.
+    Must be called with live_state_lock held.
+    """
+    global live_state
+    if live_state is not None and not live_state.writer_alive():
+        # Writer exited or was restarted: this mapping is orphaned
+        live_state.close()
+        live_state = None
+    if live_state is None:
+        try:
+            ring = LiveStateRing.attach()
+        except FileNotFoundError:
+            return None
+        if not ring.writer_alive():
+            ring.close()
+            return None
+        live_state = ring
+    return live_state
+
+def load_live_records(n):
+    """Copy of the latest n ring records, or None if the predictor isn't running."""
+    with live_state_lock:
+        ring = get_live_state()
+        if ring is None:
+            return None
+        records = ring.latest(n)
+    return records if len(records) else None
+
 def load_latest_data():
-    """Load the latest prediction data from the blockchain log."""
+    """Load the latest prediction data from the live ring, else the blockchain log."""
     try:
+        records = load_live_records(1)
+        if records is not None:
+            return record_to_dict(records[-1])
         if not os.path.exists(LOG_FILE):
             return {"distance": 0, "timestamp": time.time(), "phases": [0, 0, 0]}
             
@@ -49,6 +88,11 @@ def load_latest_data():
 
 def load_historical_data(n_points=100):
     try:
+        records = load_live_records(n_points)
+        if records is not None:
+            df = pd.DataFrame([record_to_dict(r) for r in records])
+            df["timestamp"] = pd.to_datetime(df["timestamp"], unit="s")
+            return df
         if not os.path.exists(LOG_FILE):
             return pd.DataFrame()
         with open(LOG_FILE) as f:
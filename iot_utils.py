@@ -1,29 +1,404 @@
 # iot_utils.py
 
 import ssl
+import time
+import random
+import threading
+from collections import deque
 import paho.mqtt.client as mqtt
 # For AWS IoT: from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient (if installed)
+try:
+    from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient
+except ImportError:
+    AWSIoTMQTTClient = None
 
-def connect_mqtt(broker, port, client_id, cafile=None, certfile=None, keyfile=None):
+MAX_PAYLOAD_SIZE = 268435455  # MQTT protocol limit
+
+
+class MQTTConnection:
+    """
+    Shared, self-healing MQTT connection used by all producers and consumers.
+
+    A single worker thread owns the underlying client: it (re)connects with
+    jittered exponential backoff, drives network I/O, and flushes a bounded
+    outbound queue in batches. publish() only enqueues, so messages survive
+    broker outages (oldest are dropped once max_queued is reached).
+    Subscriptions are replayed on every reconnect.
+    """
+
+    def __init__(self, broker, port, client_id="", cafile=None, certfile=None,
+                 keyfile=None, qos=1, max_inflight=20, max_queued=10000,
+                 batch_size=100, keepalive=60, connect_timeout=10.0,
+                 backoff_base=0.5, backoff_max=30.0):
+        self.broker = broker
+        self.port = port
+        self.client_id = client_id
+        self.tls = (cafile, certfile, keyfile)
+        self.qos = qos
+        self.max_inflight = max_inflight
+        self.batch_size = batch_size
+        self.keepalive = keepalive
+        self.connect_timeout = connect_timeout
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._queue = deque(maxlen=max_queued)
+        self._subscriptions = {}
+        self._connected = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._attempt = 0
+        self._started_at = time.time()
+        self._counters = {"published": 0, "published_bytes": 0, "received": 0,
+                          "received_bytes": 0, "dropped": 0, "reconnects": 0}
+        # Re-entrant: stats() is called from SIGINT handlers that may interrupt
+        # publish() on the same thread. Also guards _subscriptions together
+        # with _connected so a subscribe() can't slip past a reconnect replay.
+        self._lock = threading.RLock()
+        self.client = None
+
+    # -- Transport hooks (overridden by AWSIoTConnection) --------------------
+
+    def _create_client(self):
+        client = mqtt.Client(client_id=self.client_id, protocol=mqtt.MQTTv5,
+                             callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
+        cafile, certfile, keyfile = self.tls
+        if cafile and certfile and keyfile:
+            client.tls_set(ca_certs=cafile, certfile=certfile, keyfile=keyfile,
+                           tls_version=ssl.PROTOCOL_TLSv1_2)
+        client.max_inflight_messages_set(self.max_inflight)
+        # Make paho refuse (MQTT_ERR_QUEUE_SIZE) rather than buffer without
+        # limit once the window is full; the bounded deque is the only buffer
+        client.max_queued_messages_set(self.max_inflight)
+        client.on_connect = self._on_connect
+        client.on_disconnect = self._on_disconnect
+        client.on_message = self._on_message
+        return client
+
+    def _open(self):
+        """Start a connection attempt; _on_connect signals success."""
+        self.client.connect(self.broker, self.port, keepalive=self.keepalive)
+
+    def _poll(self, timeout):
+        """Drive network I/O for up to `timeout` seconds. Returns False if the link is down."""
+        rc = self.client.loop(timeout=timeout)
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            self._connected.clear()
+            return False
+        return True
+
+    def _send(self, topic, payload, qos):
+        """Hand one message to the client. Returns False if it must be requeued."""
+        rc = self.client.publish(topic, payload, qos=qos).rc
+        if rc == mqtt.MQTT_ERR_QUEUE_SIZE:
+            return False
+        if rc == mqtt.MQTT_ERR_NO_CONN:
+            self._connected.clear()
+            # paho keeps QoS>=1 messages for redelivery after reconnect;
+            # requeueing those would send them twice. QoS 0 is discarded.
+            return qos > 0
+        return True
+
+    def _subscribe(self, topic, qos):
+        self.client.subscribe(topic, qos=qos)
+
+    def _wake(self):
+        """Interrupt a blocking _poll so newly queued messages go out now."""
+        # Same self-pipe paho writes to when publish() is called off-thread
+        sock = getattr(self.client, "_sockpairW", None)
+        if sock is not None:
+            try:
+                sock.send(b"0")
+            except OSError:
+                pass
+
+    def _close(self):
+        self.client.disconnect()
+
+    # -- Client callbacks ------------------------------------------------------
+
+    def _on_connect(self, client, userdata, flags, rc, properties=None):
+        if rc != 0:
+            print(f"MQTT connect to {self.broker}:{self.port} refused: {rc}")
+            return
+        with self._lock:
+            for topic, (qos, _) in self._subscriptions.items():
+                self._subscribe(topic, qos)
+            self._connected.set()
+        self._attempt = 0
+        print(f"Connected to MQTT broker {self.broker}:{self.port}")
+
+    def _on_disconnect(self, client, userdata, flags, rc, properties=None):
+        self._connected.clear()
+        if not self._stop.is_set():
+            print(f"Disconnected from MQTT broker with result code {rc}, reconnecting...")
+
+    def _on_message(self, client, userdata, msg):
+        self._dispatch(msg.topic, msg.payload)
+
+    def _dispatch(self, topic, payload):
+        self._count(received=1, received_bytes=len(payload))
+        with self._lock:
+            subscriptions = list(self._subscriptions.items())
+        for pattern, (_, callback) in subscriptions:
+            if mqtt.topic_matches_sub(pattern, topic):
+                # A faulty handler must not tear down a healthy session
+                try:
+                    callback(topic, payload)
+                except Exception as e:
+                    print(f"Error in subscriber callback for '{topic}': {e}")
+
+    # -- Public interface ------------------------------------------------------
+
+    def start(self):
+        """Start the background worker; returns immediately."""
+        if self._thread is not None:
+            return self
+        self.client = self._create_client()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def wait_connected(self, timeout=None):
+        return self._connected.wait(timeout)
+
+    def is_connected(self):
+        return self._connected.is_set()
+
+    def subscribe(self, topic, callback, qos=None):
+        """
+        Register callback(topic, payload) for a topic filter. The subscription
+        is (re)issued every time the connection comes up.
+        """
+        qos = self.qos if qos is None else qos
+        with self._lock:
+            self._subscriptions[topic] = (qos, callback)
+            if self.is_connected():
+                self._subscribe(topic, qos)
+
+    def publish(self, topic, payload, qos=None):
+        """
+        Queue a message for delivery. Never blocks on the network.
+        Raises ValueError for topics or payloads the broker would reject.
+        """
+        if not topic or "+" in topic or "#" in topic:
+            raise ValueError(f"Invalid publish topic: {topic!r}")
+        if isinstance(payload, str):
+            payload = payload.encode()
+        if len(payload) > MAX_PAYLOAD_SIZE:
+            raise ValueError(f"Payload too large: {len(payload)} bytes")
+        qos = self.qos if qos is None else qos
+        with self._lock:
+            if len(self._queue) == self._queue.maxlen:
+                self._counters["dropped"] += 1
+            self._queue.append((topic, payload, qos))
+        self._wake()
+
+    def stats(self):
+        """Per-connection throughput counters."""
+        with self._lock:
+            stats = dict(self._counters)
+            stats["queued"] = len(self._queue)
+        elapsed = max(time.time() - self._started_at, 1e-9)
+        stats["connected"] = self.is_connected()
+        stats["publish_rate"] = stats["published"] / elapsed
+        stats["receive_rate"] = stats["received"] / elapsed
+        return stats
+
+    def close(self, timeout=5.0):
+        """Flush what we can within `timeout`, then disconnect."""
+        deadline = time.time() + timeout
+        while self._queue and self.is_connected() and time.time() < deadline:
+            time.sleep(0.05)
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=max(deadline - time.time(), 1.0))
+            self._thread = None
+
+    # -- Worker ------------------------------------------------------------
+
+    def _count(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                self._counters[key] += value
+
+    def _backoff(self):
+        """Full-jitter exponential backoff, so many clients don't reconnect in lockstep."""
+        ceiling = min(self.backoff_max, self.backoff_base * (2 ** self._attempt))
+        self._attempt += 1
+        return random.uniform(0, ceiling)
+
+    def _flush(self):
+        """
+        Send up to batch_size queued messages; requeue on refusal.
+        Returns True if messages are still queued that could be sent right away.
+        """
+        for _ in range(self.batch_size):
+            with self._lock:
+                if not self._queue:
+                    return False
+                topic, payload, qos = self._queue.popleft()
+            try:
+                accepted = self._send(topic, payload, qos)
+            except Exception as e:
+                # Malformed message: drop it rather than kill the worker
+                print(f"Dropping unpublishable message on '{topic}': {e}")
+                self._count(dropped=1)
+                continue
+            if not accepted:
+                with self._lock:
+                    if len(self._queue) == self._queue.maxlen:
+                        # Refilled while we were sending: this is the oldest, drop it
+                        self._counters["dropped"] += 1
+                    else:
+                        self._queue.appendleft((topic, payload, qos))
+                return False
+            self._count(published=1, published_bytes=len(payload))
+        return bool(self._queue)
+
+    def _run(self):
+        ever_connected = False
+        while not self._stop.is_set():
+            if not self.is_connected():
+                try:
+                    self._open()
+                    # Wait for the CONNACK before deciding the attempt failed
+                    deadline = time.time() + self.connect_timeout
+                    while not self.is_connected() and time.time() < deadline \
+                            and not self._stop.is_set():
+                        if not self._poll(0.1):
+                            break
+                except Exception as e:
+                    print(f"MQTT connection error: {e}")
+                if not self.is_connected():
+                    self._stop.wait(self._backoff())
+                    continue
+                if ever_connected:
+                    self._count(reconnects=1)
+                ever_connected = True
+            backlog = self._flush()
+            try:
+                # publish() wakes the poll, so only a backlog needs a zero timeout
+                self._poll(0 if backlog else 0.05)
+            except Exception as e:
+                print(f"MQTT network error: {e}")
+                self._connected.clear()
+        try:
+            if self.is_connected():
+                self._flush()
+                self._poll(0.1)
+            self._close()
+        except Exception:
+            pass
+
+
+class AWSIoTConnection(MQTTConnection):
+    """
+    Same interface as MQTTConnection, backed by the AWS IoT Device SDK.
+
+    The SDK cannot hand reconnects over to us, so after the first successful
+    connect it owns them (with a per-connection randomised backoff) and
+    restores subscriptions itself; onOnline/onOffline drive the connected
+    flag. The worker only retries the initial connect and flushes the queue.
+    """
+
+    def __init__(self, client_id, endpoint, port=8883, cafile='root-CA.crt',
+                 certfile='device.pem.crt', keyfile='private.pem.key', **kwargs):
+        super().__init__(endpoint, port, client_id=client_id, cafile=cafile,
+                         certfile=certfile, keyfile=keyfile, **kwargs)
+        self._sdk_connected_once = False
+        self._wakeup = threading.Event()
+        self._inflight = 0
+
+    def _create_client(self):
+        if AWSIoTMQTTClient is None:
+            raise NotImplementedError("AWS IoT integration requires AWSIoTPythonSDK.")
+        cafile, certfile, keyfile = self.tls
+        client = AWSIoTMQTTClient(self.client_id)
+        client.configureEndpoint(self.broker, self.port)
+        client.configureCredentials(cafile, keyfile, certfile)
+        # The SDK backoff is deterministic, so jitter its base per connection
+        # to keep a fleet from reconnecting in lockstep
+        base = max(1, round(random.uniform(self.backoff_base, 2 * self.backoff_base + 1)))
+        client.configureAutoReconnectBackoffTime(base, max(base, int(self.backoff_max)), 20)
+        # Queueing is done by our bounded deque, not by the SDK
+        client.configureOfflinePublishQueueing(0)
+        client.configureConnectDisconnectTimeout(self.connect_timeout)
+        client.configureMQTTOperationTimeout(self.connect_timeout)
+        client.onOnline = self._on_online
+        client.onOffline = self._connected.clear
+        return client
+
+    def _on_online(self):
+        with self._lock:
+            self._inflight = 0  # Acks for the previous session will never arrive
+            self._connected.set()
+
+    def _open(self):
+        if self._sdk_connected_once:
+            # SDK is reconnecting on its own; just wait for onOnline
+            self._connected.wait(self.connect_timeout)
+            return
+        # Blocking; done outside the lock so publish() never waits on it
+        if not self.client.connect(keepAliveIntervalSecond=self.keepalive):
+            return
+        self._sdk_connected_once = True
+        with self._lock:
+            for topic, (qos, _) in self._subscriptions.items():
+                self._subscribe(topic, qos)
+            self._connected.set()
+        self._attempt = 0
+
+    def _poll(self, timeout):
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+        return self.is_connected()
+
+    def _wake(self):
+        self._wakeup.set()
+
+    def _on_puback(self, mid):
+        with self._lock:
+            self._inflight = max(self._inflight - 1, 0)
+
+    def _send(self, topic, payload, qos):
+        if qos > 0:
+            with self._lock:
+                if self._inflight >= self.max_inflight:
+                    return False
+                self._inflight += 1
+        try:
+            self.client.publishAsync(topic, payload, qos,
+                                     ackCallback=self._on_puback if qos > 0 else None)
+            return True
+        except Exception:
+            if qos > 0:
+                self._on_puback(None)
+            return False
+
+    def _subscribe(self, topic, qos):
+        self.client.subscribe(
+            topic, qos, lambda client, userdata, msg: self._dispatch(msg.topic, msg.payload))
+
+    def _close(self):
+        self.client.disconnect()
+
+
+def connect_mqtt(broker, port, client_id="", cafile=None, certfile=None, keyfile=None,
+                 **kwargs):
     """
     Connect to an MQTT broker (non-AWS) using Paho.
+    Returns a started MQTTConnection; see its constructor for QoS, inflight,
+    queue and backoff settings.
+    """
+    return MQTTConnection(broker, port, client_id=client_id, cafile=cafile,
+                          certfile=certfile, keyfile=keyfile, **kwargs).start()
+
+def connect_aws_iot(client_id, endpoint, port=8883, cafile='root-CA.crt',
+                    certfile='device.pem.crt', keyfile='private.pem.key', **kwargs):
+    """
+    Connect to AWS IoT (requires AWSIoTPythonSDK).
+    Returns a started AWSIoTConnection with the same interface as connect_mqtt.
     """
-    client = mqtt.Client(client_id=client_id)
-    if cafile and certfile and keyfile:
-        client.tls_set(ca_certs=cafile, certfile=certfile, keyfile=keyfile, 
-                       tls_version=ssl.PROTOCOL_TLSv1_2)
-    client.connect(broker, port)
-    return client
-
-def connect_aws_iot(client_id, endpoint, port=8883, cafile='root-CA.crt', 
-                    certfile='device.pem.crt', keyfile='private.pem.key'):
-    """
-    Stub for AWS IoT connection (requires AWSIoTPythonSDK).
-    """
-    # Example using AWS IoT Device SDK:
-    # aws_client = AWSIoTMQTTClient(client_id)
-    # aws_client.configureEndpoint(endpoint, port)
-    # aws_client.configureCredentials(cafile, keyfile, certfile)
-    # aws_client.connect()
-    # return aws_client
-    raise NotImplementedError("AWS IoT integration requires AWSIoTPythonSDK.")
+    return AWSIoTConnection(client_id, endpoint, port, cafile=cafile,
+                            certfile=certfile, keyfile=keyfile, **kwargs).start()
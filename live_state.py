@@ -0,0 +1,193 @@
+# live_state.py
+
+import os
+import time
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+SHM_NAME = "radar_live_state"
+CAPACITY = 1024        # Number of records kept in the ring
+MAX_PHASES = 8         # Fixed width of the phase vector
+SENSOR_ID_LEN = 32     # Fixed width of the sensor id (UTF-8 bytes)
+HEARTBEAT_TIMEOUT = 5.0  # Seconds without a heartbeat before the writer counts as gone
+
+# Header: total number of records ever written (monotonic sequence counter),
+# the writer's pid (0 once it has shut down), its last heartbeat time and the
+# number of slots (readers can't derive it: shm.size may be page-rounded)
+HEADER_DTYPE = np.dtype([("seq", "<u8"), ("pid", "<i8"), ("heartbeat", "<f8"),
+                         ("capacity", "<u8")])
+
+# One fixed-width record. "seq" is the 1-based sequence number of the record
+# stored in the slot, or 0 while the writer is updating it.
+RECORD_DTYPE = np.dtype([
+    ("seq", "<u8"),
+    ("timestamp", "<f8"),
+    ("sensor_id", f"S{SENSOR_ID_LEN}"),
+    ("distance", "<f8"),
+    ("n_phases", "<u1"),
+    ("phases", "<f8", (MAX_PHASES,)),
+])
+
+
+def _pid_alive(pid):
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OverflowError):
+        return True
+    return True
+
+
+class LiveStateRing:
+    """
+    Shared-memory ring buffer of the latest predictions.
+
+    A single writer (the predictor) appends fixed-width records and bumps a
+    sequence counter; any number of local readers (the dashboard, ...) poll
+    the counter and read new slots directly out of shared memory, with no
+    locks and no parsing. Each slot carries its own sequence number, which
+    the reader checks after copying so torn or overwritten records are
+    skipped. The header records the writer's pid and a heartbeat so readers
+    can tell when the writer is gone or the segment has been replaced.
+    The blockchain ledger remains the durable record.
+    """
+
+    def __init__(self, shm, capacity, owner):
+        self.shm = shm
+        self.capacity = capacity
+        self.owner = owner
+        self.header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=shm.buf)
+        self.records = np.ndarray((capacity,), dtype=RECORD_DTYPE, buffer=shm.buf,
+                                  offset=HEADER_DTYPE.itemsize)
+        self.last_seq = 0
+
+    @classmethod
+    def create(cls, name=SHM_NAME, capacity=CAPACITY):
+        """
+        Create the ring as the writer. An existing segment is only replaced if
+        its writer is dead; if another writer is alive, RuntimeError is raised.
+        """
+        size = HEADER_DTYPE.itemsize + capacity * RECORD_DTYPE.itemsize
+        try:
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            existing = cls.attach(name)
+            alive = existing.writer_alive()
+            pid = existing.writer_pid()
+            existing.close()
+            if alive:
+                raise RuntimeError(
+                    f"Live-state ring '{name}' is in use by running writer pid {pid}")
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        ring = cls(shm, capacity, owner=True)
+        ring.header["seq"][0] = 0
+        ring.header["capacity"][0] = capacity
+        ring.records["seq"] = 0
+        ring.header["pid"][0] = os.getpid()
+        ring.heartbeat()
+        return ring
+
+    @classmethod
+    def attach(cls, name=SHM_NAME):
+        """Attach to an existing ring as a reader. Raises FileNotFoundError if absent."""
+        shm = shared_memory.SharedMemory(name=name)
+        # Readers must not unlink the writer's segment when they exit
+        resource_tracker.unregister(shm._name, "shared_memory")
+        header = np.ndarray((1,), dtype=HEADER_DTYPE, buffer=shm.buf)
+        capacity = int(header["capacity"][0])
+        del header
+        fits = HEADER_DTYPE.itemsize + capacity * RECORD_DTYPE.itemsize <= shm.size
+        # A segment from an older layout reads as empty and never alive
+        return cls(shm, capacity if fits else 0, owner=False)
+
+    def append(self, timestamp, sensor_id, distance, phases):
+        """Write one record (writer only)."""
+        seq = self.head() + 1
+        i = (seq - 1) % self.capacity
+        phases = np.asarray(phases, dtype=np.float64)[:MAX_PHASES]
+        records = self.records
+        records["seq"][i] = 0
+        records["timestamp"][i] = timestamp
+        records["sensor_id"][i] = str(sensor_id).encode()[:SENSOR_ID_LEN]
+        records["distance"][i] = distance
+        records["n_phases"][i] = len(phases)
+        records["phases"][i, :len(phases)] = phases
+        records["phases"][i, len(phases):] = 0.0
+        records["seq"][i] = seq
+        self.header["seq"][0] = seq
+        self.heartbeat()
+
+    def heartbeat(self):
+        """Mark the writer as alive (writer only); call at least every few seconds."""
+        self.header["heartbeat"][0] = time.time()
+
+    def writer_pid(self):
+        return int(self.header["pid"][0]) if self.capacity else 0
+
+    def writer_alive(self, timeout=HEARTBEAT_TIMEOUT):
+        """
+        False once the writer has shut down, died, or stopped heartbeating.
+        A reader seeing False holds an orphaned segment and should re-attach.
+        """
+        if not self.capacity:
+            return False
+        fresh = time.time() - float(self.header["heartbeat"][0]) <= timeout
+        return fresh and _pid_alive(self.writer_pid())
+
+    def head(self):
+        """Sequence number of the most recent record (0 if empty)."""
+        return int(self.header["seq"][0])
+
+    def _snapshot(self, first, last):
+        """Copy records with sequence numbers first..last, dropping torn slots."""
+        if last < first:
+            return np.empty(0, dtype=RECORD_DTYPE)
+        seqs = np.arange(first, last + 1, dtype=np.uint64)
+        rows = self.records[(seqs - 1) % self.capacity].copy()
+        # Re-check the live slots after copying: a mismatch means the writer
+        # lapped or was mid-write on that slot while we read it
+        live = self.records["seq"][(seqs - 1) % self.capacity]
+        return rows[(rows["seq"] == seqs) & (live == seqs)]
+
+    def read_new(self):
+        """Records written since the previous call (oldest first)."""
+        head = self.head()
+        first = max(self.last_seq + 1, head - self.capacity + 1, 1)
+        self.last_seq = head
+        return self._snapshot(first, head)
+
+    def latest(self, n=1):
+        """The most recent n records (oldest first)."""
+        head = self.head()
+        return self._snapshot(max(head - min(n, self.capacity) + 1, 1), head)
+
+    def close(self):
+        """
+        Unmap the segment (and unlink it, for the writer). Any thread still
+        reading this ring would fault, so callers sharing it must serialise
+        reads and close().
+        """
+        if self.owner:
+            # Tell attached readers the segment is going away
+            self.header["pid"][0] = 0
+        # Drop our views first; SharedMemory.close() refuses while they exist
+        self.header = self.records = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def record_to_dict(record):
+    """Convert a ring record to the same dict shape the ledger stores."""
+    return {
+        "distance": float(record["distance"]),
+        "timestamp": float(record["timestamp"]),
+        "sensor_id": record["sensor_id"].decode(errors="replace"),
+        "phases": record["phases"][:record["n_phases"]].tolist(),
+    }
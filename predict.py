@@ -4,11 +4,12 @@ import json
 import time
 import pickle
 import numpy as np
-import paho.mqtt.client as mqtt
 import signal
-import sys
+import threading
+from collections import OrderedDict
 from unwrap import weighted_crt_unwrap
 from blockchain_log import BlockchainLogger
+from live_state import LiveStateRing
 from iot_utils import connect_mqtt, connect_aws_iot
 # At top of predict.py, change:
 USE_MQTT = True
@@ -23,17 +24,111 @@ model_loaded = True
 # Initialize blockchain logger
 logger = BlockchainLogger('predictions_log.json')
 
+# Shared-memory ring with the latest predictions for local readers (dashboard),
+# created in main() so importing this module never takes over the channel
+live_state = None
+
 # Flag to enable cloud features
 USE_MQTT = True
 USE_AWS = False
+AWS_ENDPOINT = "your-endpoint.iot.us-east-1.amazonaws.com"
+
+# Load shedding: phase vectors older than this (seconds) are dropped unprocessed
+STALENESS_DEADLINE = 0.5
+STATS_INTERVAL = 10.0   # Seconds between stats publications on STATS_TOPIC
+STATS_TOPIC = "radar/predictor/stats"
+
+# Shared connection (MQTT or AWS IoT), created in main()
+connection = None
+
+class AdmissionStage:
+    """
+    Per-sensor admission queue between the network thread and the predictor.
+
+    Holds at most one pending message per sensor: a newer message replaces
+    the queued one (coalescing), and messages that waited longer than the
+    staleness deadline are dropped when dequeued. Under overload the backlog
+    is therefore bounded by the number of sensors and latency by the deadline.
+    """
+
+    def __init__(self, deadline=STALENESS_DEADLINE):
+        self.deadline = deadline
+        self._pending = OrderedDict()  # sensor_id -> (arrival time, payload)
+        self._cond = threading.Condition()
+        self._counters = {"admitted": 0, "coalesced": 0, "expired": 0, "processed": 0}
+        self._age_sum = 0.0
+        self._age_max = 0.0
+        self._age_last = 0.0
+
+    def put(self, sensor_id, payload):
+        """Admit a message, replacing any older one still queued for the sensor."""
+        now = time.monotonic()
+        with self._cond:
+            self._counters["admitted"] += 1
+            if sensor_id in self._pending:
+                # Keep the sensor's place in line so busy sensors can't starve others
+                self._counters["coalesced"] += 1
+            self._pending[sensor_id] = (now, payload)
+            self._cond.notify()
+
+    def get(self, timeout=None):
+        """
+        Return (sensor_id, payload, queue_age) for the oldest fresh message,
+        or None if nothing fresh arrived within `timeout` seconds.
+        """
+        end = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                while self._pending:
+                    sensor_id, (arrival, payload) = self._pending.popitem(last=False)
+                    age = time.monotonic() - arrival
+                    if age > self.deadline:
+                        self._counters["expired"] += 1
+                        continue
+                    self._counters["processed"] += 1
+                    self._age_sum += age
+                    self._age_max = max(self._age_max, age)
+                    self._age_last = age
+                    return sensor_id, payload, age
+                remaining = None if end is None else end - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def stats(self):
+        """Shed counts and queue-age metrics (ages in seconds)."""
+        with self._cond:
+            stats = dict(self._counters)
+            stats["shed"] = stats["coalesced"] + stats["expired"]
+            stats["pending"] = len(self._pending)
+            now = time.monotonic()
+            stats["oldest_pending_age"] = max(
+                (now - arrival for arrival, _ in self._pending.values()), default=0.0)
+            processed = stats["processed"]
+            stats["queue_age_mean"] = self._age_sum / processed if processed else 0.0
+            stats["queue_age_max"] = self._age_max
+            stats["queue_age_last"] = self._age_last
+        return stats
+
+admission = AdmissionStage()
 
 # MQTT callback: received new phase vector
-def on_message(client, userdata, msg, properties=None):
+def on_message(topic, payload):
     """
-    Callback when an MQTT message is received on the subscribed topic.
+    Callback when a message is received on the subscribed topic. Runs on the
+    connection thread, so it only decodes and hands off to the admission stage.
+    """
+    try:
+        payload = json.loads(payload.decode())
+        admission.put(payload.get("sensor_id", "radar-0"), payload)
+    except Exception as e:
+        print("Error admitting message:", e)
+
+def process_message(sensor_id, payload):
+    """
+    Predict range for one admitted phase vector, then publish and log it.
     """
     try:
-        payload = json.loads(msg.payload.decode())
         phases = np.array(payload["phases"])  # e.g. in radians
         freqs = np.array(payload["freqs"])
         # Method 1: CRT unwrap
@@ -44,51 +139,57 @@ def on_message(client, userdata, msg, properties=None):
         # Combine or choose (here we average)
         d_pred = float(np.mean([d_crt, d_rf, d_huber]))
         timestamp = time.time()
-        result = {"distance": d_pred, "timestamp": timestamp, "phases": phases.tolist()}
+        result = {"distance": d_pred, "timestamp": timestamp, "sensor_id": sensor_id,
+                  "phases": phases.tolist()}
         print(f"Predicted distance: {d_pred:.2f} m")
-        # Publish or store prediction
-        if USE_MQTT:
-            client.publish("radar/predictions", json.dumps(result))
-        if USE_AWS:
-            # For AWS IoT, use specialized AWS IoT client (stub below)
-            pass  # e.g., aws_client.publish(topic, json.dumps(result))
-        # Log in blockchain
+        # Publish prediction (queued, delivered once the broker is reachable)
+        connection.publish("radar/predictions", json.dumps(result))
+        # Expose to local readers immediately, then log durably in blockchain
+        live_state.append(timestamp, sensor_id, d_pred, phases)
         logger.add_record(result)
     except Exception as e:
         print("Error processing message:", e)
 
-def on_disconnect(client, userdata, flags, rc, properties=None):
-    print(f"Disconnected with result code {rc}")
+# Set by SIGINT; main() finishes the current message, then shuts down cleanly
+shutdown = threading.Event()
 
 def signal_handler(sig, frame):
+    # Only flag the request: closing the ring here could unmap it under an
+    # append() that the signal interrupted
     print("\nShutting down predictor...")
-    if USE_MQTT:
-        client.disconnect()
-    sys.exit(0)
+    shutdown.set()
 
 signal.signal(signal.SIGINT, signal_handler)
 
 def main():
-    if USE_MQTT:
-        client = mqtt.Client(protocol=mqtt.MQTTv5, callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-        client.connect(BROKER_HOST, BROKER_PORT)
-        client.on_message = on_message
-        client.on_disconnect = on_disconnect
-        client.subscribe("radar/phases")
-        print("Subscribed to MQTT topic 'radar/phases'.")
-        try:
-            client.loop_forever()
-        except KeyboardInterrupt:
-            signal_handler(signal.SIGINT, None)
-
+    global connection, live_state
+    if not (USE_AWS or USE_MQTT):
+        return
+    # Fails loudly if another predictor already owns the channel
+    live_state = LiveStateRing.create()
     if USE_AWS:
-        aws_client = connect_aws_iot(...)
-        aws_client.subscribe("radar/phases", callback=on_message)
-        aws_client.connect()
-        print("Subscribed to AWS IoT topic 'radar/phases'.")
-        # AWS SDK may block internally or provide a similar loop...
-        while True:
-            time.sleep(1)
+        connection = connect_aws_iot("radar-predictor", AWS_ENDPOINT)
+    else:
+        connection = connect_mqtt(BROKER_HOST, BROKER_PORT, client_id="radar-predictor")
+    connection.subscribe("radar/phases", on_message)
+    print("Subscribed to topic 'radar/phases'.")
+    next_stats = time.monotonic() + STATS_INTERVAL
+    try:
+        while not shutdown.is_set():
+            item = admission.get(timeout=1.0)
+            live_state.heartbeat()
+            if item is not None:
+                sensor_id, payload, _ = item
+                process_message(sensor_id, payload)
+            if time.monotonic() >= next_stats:
+                connection.publish(STATS_TOPIC, json.dumps(
+                    {"admission": admission.stats(), "connection": connection.stats()}))
+                next_stats = time.monotonic() + STATS_INTERVAL
+    finally:
+        connection.close()
+        print(f"Connection stats: {connection.stats()}")
+        print(f"Admission stats: {admission.stats()}")
+        live_state.close()
 
 if __name__ == "__main__":
     main()
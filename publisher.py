@@ -1,13 +1,14 @@
-import paho.mqtt.client as mqtt
 import json
 import time
 import signal
 import sys
+from iot_utils import connect_mqtt
+
+# Shared connection, created in main()
+connection = None
 
 def create_client():
-    client = mqtt.Client(protocol=mqtt.MQTTv5, callback_api_version=mqtt.CallbackAPIVersion.VERSION2)
-    client.connect("localhost", 1883)
-    return client
+    return connect_mqtt("localhost", 1883, client_id="radar-publisher")
 
 def publish_message(client):
     phases = [0.1, -2.3, 1.2]
@@ -17,18 +18,20 @@ def publish_message(client):
 
 def signal_handler(sig, frame):
     print("\nShutting down publisher...")
+    if connection is not None:
+        connection.close()
+        print(f"Connection stats: {connection.stats()}")
     sys.exit(0)
 
 signal.signal(signal.SIGINT, signal_handler)
 
 def main():
+    global connection
+    connection = create_client()
     while True:
         try:
-            client = create_client()
-            client.loop_start()
-            publish_message(client)
-            client.loop_stop()
-            client.disconnect()
+            # Messages are buffered by the connection while the broker is down
+            publish_message(connection)
             time.sleep(1)
         except KeyboardInterrupt:
             signal_handler(signal.SIGINT, None)
@@ -37,4 +40,4 @@ def main():
             time.sleep(1)
 
 if __name__ == "__main__":
-    main() 
\ No newline at end of file
+    main()